@@ -4,6 +4,7 @@ from . import Sparse
 from . import Dense2
 
 _add_dim = misc._add_dim; _pad_last = misc._pad_last; _concatenate=misc._concatenate;
+_concatenate_padded = misc._concatenate_padded
 
 
 class spAD2(np.ndarray):
@@ -13,27 +14,33 @@ class spAD2(np.ndarray):
 
 	# Construction
 	# See : https://docs.scipy.org/doc/numpy-1.13.0/user/basics.subclassing.html
-	def __new__(cls,value,coef1=None,index=None,coef2=None,index_row=None,index_col=None,broadcast_ad=False):
+	def __new__(cls,value,coef1=None,index=None,coef2=None,index_row=None,index_col=None,broadcast_ad=False,
+		dtype_val=None,dtype_idx=None):
+		"""
+		Optional dtype_val and dtype_idx set the types of the AD coefficients and indices,
+		e.g. np.float32 and np.int32 to reduce memory usage. By default, the types 
+		of the provided arrays are kept (float and int for missing arrays).
+		"""
 		if isinstance(value,spAD2):
 			assert coef1 is None and index is None and coef2 is None and index_row is None and index_col is None
 			return value
 		obj = np.asarray(value).view(spAD2)
 		shape = obj.shape
 		shape2 = shape+(0,)
+		def ad_array(arr,dtype,default_dtype):
+			if arr is None: return np.full(shape2,0,dtype=default_dtype if dtype is None else dtype)
+			arr = misc._test_or_broadcast_ad(arr,shape,broadcast_ad)
+			return arr if dtype is None else arr.astype(dtype,copy=False)
+
 		assert ((coef1 is None) and (index is None)) or (coef1.shape==index.shape)
-		obj.coef1 = (np.full(shape2,0.) if coef1  is None 
-			else misc._test_or_broadcast_ad(coef1,shape,broadcast_ad) )
-		obj.index = (np.full(shape2,0)  if index is None  
-			else misc._test_or_broadcast_ad(index,shape,broadcast_ad) )
+		obj.coef1 = ad_array(coef1,dtype_val,float)
+		obj.index = ad_array(index,dtype_idx,int)
 		
 		assert (((coef2 is None) and (index_row is None) and (index_col is None)) 
 			or ((coef2.shape==index_row.shape) and (coef2.shape==index_col.shape)))
-		obj.coef2 = (np.full(shape2,0.) if coef2  is None 
-			else misc._test_or_broadcast_ad(coef2,shape,broadcast_ad) )
-		obj.index_row = (np.full(shape2,0)  if index_row is None 
-			else misc._test_or_broadcast_ad(index_row,shape,broadcast_ad) )
-		obj.index_col = (np.full(shape2,0)  if index_col is None 
-			else misc._test_or_broadcast_ad(index_col,shape,broadcast_ad) )
+		obj.coef2 = ad_array(coef2,dtype_val,float)
+		obj.index_row = ad_array(index_row,dtype_idx,int)
+		obj.index_col = ad_array(index_col,dtype_idx,int)
 		return obj
 
 #	def __array_finalize__(self,obj): pass
@@ -81,15 +88,18 @@ class spAD2(np.ndarray):
 			index_row_a,index_row_b = np.broadcast_to(self.index_row,coef2_a.shape),np.broadcast_to(other.index_row,coef2_b.shape)
 			index_col_a,index_col_b = np.broadcast_to(self.index_col,coef2_a.shape),np.broadcast_to(other.index_col,coef2_b.shape)
 
-			len_a,len_b = self.coef1.shape[-1],other.coef1.shape[-1]
-			coef2_ab = np.repeat(self.coef1,len_b,axis=-1) * np.tile(other.coef1,len_a) 
-			index2_a = np.broadcast_to(np.repeat(self.index,len_b,axis=-1),coef2_ab.shape)
-			index2_b = np.broadcast_to(np.tile(other.index,len_a),coef2_ab.shape)
+			# Outer product of the first order coefficients, flattened in the last axis
+			coef2_ab = _add_dim(self.coef1) * np.expand_dims(other.coef1,axis=-2)
+			index2_a = np.broadcast_to(_add_dim(self.index),coef2_ab.shape)
+			index2_b = np.broadcast_to(np.expand_dims(other.index,axis=-2),coef2_ab.shape)
+			coef2_ab,index2_a,index2_b = (_flatten_nlast(e,2) for e in (coef2_ab,index2_a,index2_b))
 
 			return spAD2(value,_concatenate(coef1_a,coef1_b),_concatenate(index_a,index_b),
 				np.concatenate((coef2_a,coef2_b,coef2_ab,coef2_ab),axis=-1),
 				np.concatenate((index_row_a,index_row_b,index2_a,index2_b),axis=-1),
 				np.concatenate((index_col_a,index_col_b,index2_b,index2_a),axis=-1))
+		elif self._no_ad():
+			return spAD2(self.value*other,self.coef1,self.index,self.coef2,self.index_row,self.index_col,broadcast_ad=True)
 		elif isinstance(other,np.ndarray):
 			value = self.value*other
 			coef1 = _add_dim(other)*self.coef1
@@ -104,6 +114,8 @@ class spAD2(np.ndarray):
 	def __truediv__(self,other):
 		if isinstance(other,spAD2):
 			return self.__mul__(other.__pow__(-1))
+		elif self._no_ad():
+			return spAD2(self.value/other,self.coef1,self.index,self.coef2,self.index_row,self.index_col,broadcast_ad=True)
 		elif isinstance(other,np.ndarray):
 			inv = 1./other
 			return spAD2(self.value*inv,self.coef1*_add_dim(inv),self.index,
@@ -112,6 +124,18 @@ class spAD2(np.ndarray):
 			inv = 1./other
 			return spAD2(self.value*inv,self.coef1*inv,self.index,self.coef2*inv,self.index_row,self.index_col)
 
+	def __iadd__(self,other):
+		result = self+other
+		if result.shape!=self.shape:
+			raise ValueError(f"non-broadcastable output operand with shape {self.shape} "
+				f"doesn't match the broadcast shape {result.shape}")
+		self.value[...] = result.value
+		self.coef1,self.index,self.coef2,self.index_row,self.index_col = (
+			result.coef1,result.index,result.coef2,result.index_row,result.index_col)
+		return self
+
+	def __isub__(self,other): return self.__iadd__(-other)
+
 	__rmul__ = __mul__
 	__radd__ = __add__
 	def __rsub__(self,other): 		return -(self-other)
@@ -154,22 +178,27 @@ class spAD2(np.ndarray):
 		b = np.moveaxis(spAD2.concatenate(t,axis=0),0,-1) # Possible performance hit if ad sizes are inhomogeneous
 		coef1 = _add_dim(a.coef1)*b.coef1
 		index1 = np.broadcast_to(b.index,coef1.shape)
-		coef2_pure = _add_dim(a.coef1)*b.coef2
-		index_row_pure = np.broadcast_to(b.index_row,coef2_pure.shape)
-		index_col_pure = np.broadcast_to(b.index_col,coef2_pure.shape)
-
-		s = b.shape[:-1]; na = a.size_ad; nb = b.size_ad1;
-		coef2_mixed = misc._add_dim2(a.coef2)*np.reshape(b.coef1,s+(na,1,nb,1))*np.reshape(b.coef1,s+(1,na,1,nb))
-		s2 = coef2_mixed.shape
-		index_row_mixed = np.broadcast_to(b.index.reshape(s+(na,1,nb,1)),s2)
-		index_col_mixed = np.broadcast_to(b.index.reshape(s+(1,na,1,nb)),s2)
-		#s3 = s2[:-4]+(na*na*nb*nb,) a.reshape(s3)
-
-		coef1,index1,coef2_pure,index_row_pure,index_col_pure = (_flatten_nlast(a,2) for a in (coef1,index1,coef2_pure,index_row_pure,index_col_pure))
-		coef2_mixed,index_row_mixed,index_col_mixed = (_flatten_nlast(a,4) for a in (coef2_mixed,index_row_mixed,index_col_mixed))
-		
-		return spAD2(a.value,coef1,index1,
-			_concatenate(coef2_pure,coef2_mixed),_concatenate(index_row_pure,index_row_mixed),_concatenate(index_col_pure,index_col_mixed))
+
+		# Second order coefficients are written directly in preallocated arrays. 
+		# The pure part comes from b.coef2, the mixed part from a.coef2 and two instances of b.coef1.
+		s = b.shape[:-1]; na = a.size_ad; nb = b.size_ad1; nb2 = b.size_ad2
+		n_pure,n_mixed = na*nb2,na*na*nb*nb
+		coef2,index_row,index_col = (np.empty(s+(n_pure+n_mixed,),dtype=t) 
+			for t in (np.result_type(a.coef2,b.coef1,b.coef2),b.index_row.dtype,b.index_col.dtype))
+		def pure(arr):  return arr[...,:n_pure].reshape(s+(na,nb2)) # Views, no copy involved
+		def mixed(arr): return arr[...,n_pure:].reshape(s+(na,na,nb,nb))
+
+		np.multiply(_add_dim(a.coef1),b.coef2,out=pure(coef2))
+		pure(index_row)[...] = b.index_row
+		pure(index_col)[...] = b.index_col
+
+		b_coef1,b_index = (np.reshape(e,s+(na,nb)) for e in (b.coef1,b.index))
+		np.multiply(misc._add_dim2(a.coef2)*b_coef1[...,:,None,:,None],b_coef1[...,None,:,None,:],out=mixed(coef2))
+		mixed(index_row)[...] = b_index[...,:,None,:,None]
+		mixed(index_col)[...] = b_index[...,None,:,None,:]
+
+		coef1,index1 = (_flatten_nlast(e,2) for e in (coef1,index1))
+		return spAD2(a.value,coef1,index1,coef2,index_row,index_col)
 
 	#Indexing
 	@property
@@ -178,6 +207,7 @@ class spAD2(np.ndarray):
 	def size_ad1(self):  return self.coef1.shape[-1]
 	@property
 	def size_ad2(self):  return self.coef2.shape[-1]
+	def _no_ad(self): return self.size_ad1==0 and self.size_ad2==0
 
 	def __getitem__(self,key):
 		ekey = misc.key_expand(key)
@@ -237,16 +267,15 @@ class spAD2(np.ndarray):
 	# Reductions
 	def sum(self,axis=None,out=None,**kwargs):
 		if axis is None: return self.flatten().sum(axis=0,out=out,**kwargs)
+		if axis<0: axis+=self.ndim
 		value = self.value.sum(axis,**kwargs)
 
-		shape1 = value.shape + (self.size_ad1 * self.shape[axis],)
-		coef1 = np.moveaxis(self.coef1, axis,-1).reshape(shape1)
-		index = np.moveaxis(self.index, axis,-1).reshape(shape1)
-
-		shape2 = value.shape + (self.size_ad2 * self.shape[axis],)
-		coef2 = np.moveaxis(self.coef2, axis,-1).reshape(shape2)
-		index_row = np.moveaxis(self.index_row, axis,-1).reshape(shape2)
-		index_col = np.moveaxis(self.index_col, axis,-1).reshape(shape2)
+		# The summed axis is merged with the ad axis, placed just before it.
+		# No copy is involved when summing over the last axis of a contiguous array.
+		def fold(arr): 
+			return np.moveaxis(arr,axis,-2).reshape(value.shape+(self.shape[axis]*arr.shape[-1],))
+		coef1,index = fold(self.coef1),fold(self.index)
+		coef2,index_row,index_col = fold(self.coef2),fold(self.index_row),fold(self.index_col)
 
 		out = spAD2(value,coef1,index,coef2,index_row,index_col)
 		return out
@@ -323,15 +352,25 @@ class spAD2(np.ndarray):
 	def bound_ad(self):
 		return 1+np.max((np.max(self.index,initial=-1),np.max(self.index_row,initial=-1),np.max(self.index_col,initial=-1)))
 	def to_dense(self,dense_size_ad=None):
-		def mvax(arr): return np.moveaxis(arr,-1,0)
 		dsad = self.bound_ad() if dense_size_ad is None else dense_size_ad
-		coef1 = np.zeros(self.shape+(dsad,))
-		for c,i in zip(mvax(self.coef1),mvax(self.index)):
-			np.put_along_axis(coef1,_add_dim(i),np.take_along_axis(coef1,_add_dim(i),axis=-1)+_add_dim(c),axis=-1)
-		coef2 = np.zeros(self.shape+(dsad*dsad,))
-		for c,i in zip(mvax(self.coef2),mvax(self.index_row*dsad+self.index_col)):
-			np.put_along_axis(coef2,_add_dim(i),np.take_along_axis(coef2,_add_dim(i),axis=-1)+_add_dim(c),axis=-1)
+		coef1 = _scatter_add_last(self.coef1,self.index,dsad)
+		coef2 = _scatter_add_last(self.coef2,self.index_row*dsad+self.index_col,dsad*dsad)
 		return Dense2.denseAD2(self.value,coef1,np.reshape(coef2,self.shape+(dsad,dsad)))
+	def coef2_sparse(self,dense_size_ad=None):
+		"""
+		Second order coefficients, as a scipy.sparse.csr_matrix of shape (self.size,dsad*dsad),
+		where dsad is the dense size ad. Memory efficient alternative to to_dense().coef2, 
+		which can be recovered as coef2_sparse().toarray().reshape(self.shape+(dsad,dsad)).
+		"""
+		import scipy.sparse
+		dsad = self.bound_ad() if dense_size_ad is None else dense_size_ad
+		n = self.size; shape2 = (n,self.size_ad2)
+		row = np.broadcast_to(_add_dim(np.arange(n)),shape2)
+		# Flat (row,col) keys range up to dsad**2, beyond the 32 bit indices range
+		col = np.reshape(self.index_row.astype(np.int64)*dsad+self.index_col,shape2)
+		coef = np.reshape(self.coef2,shape2)
+		return scipy.sparse.csr_matrix((coef.flatten(),(row.flatten(),col.flatten())),shape=(n,int(dsad)**2))
+
 	def to_first(self):
 		return Sparse.spAD(self.value,self.coef1,self.index)
 
@@ -386,21 +425,52 @@ class spAD2(np.ndarray):
 		size_ad2 = max(e.size_ad2 for e in elems2)
 		return spAD2( 
 		np.concatenate(tuple(e.value for e in elems2), axis=axis), 
-		np.concatenate(tuple(_pad_last(e.coef1,size_ad1)  for e in elems2),axis=axis1),
-		np.concatenate(tuple(_pad_last(e.index,size_ad1)  for e in elems2),axis=axis1),
-		np.concatenate(tuple(_pad_last(e.coef2,size_ad2)  for e in elems2),axis=axis1),
-		np.concatenate(tuple(_pad_last(e.index_row,size_ad2)  for e in elems2),axis=axis1),
-		np.concatenate(tuple(_pad_last(e.index_col,size_ad2)  for e in elems2),axis=axis1))
+		_concatenate_padded(tuple(e.coef1 for e in elems2),axis1,size_ad1),
+		_concatenate_padded(tuple(e.index for e in elems2),axis1,size_ad1),
+		_concatenate_padded(tuple(e.coef2 for e in elems2),axis1,size_ad2),
+		_concatenate_padded(tuple(e.index_row for e in elems2),axis1,size_ad2),
+		_concatenate_padded(tuple(e.index_col for e in elems2),axis1,size_ad2))
+
+	@staticmethod
+	def sum_many(terms):
+		"""
+		Sum of several terms, some of which are spAD2 instances.
+		The AD coefficients are copied once, into preallocated arrays.
+		"""
+		terms = tuple(terms)
+		ad_terms = tuple(t for t in terms if isinstance(t,spAD2))
+		value = sum(t.value if isinstance(t,spAD2) else t for t in terms)
+		value = np.asarray(value); shape = value.shape
+
+		size_ad1 = sum(t.size_ad1 for t in ad_terms)
+		size_ad2 = sum(t.size_ad2 for t in ad_terms)
+		def empty(size,name,default_dtype): 
+			dtype = np.result_type(*(getattr(t,name) for t in ad_terms)) if ad_terms else default_dtype
+			return np.empty(shape+(size,),dtype=dtype)
+		coef1,index = empty(size_ad1,'coef1',float),empty(size_ad1,'index',int)
+		coef2,index_row,index_col = (empty(size_ad2,name,default_dtype) for name,default_dtype in 
+			(('coef2',float),('index_row',int),('index_col',int)))
+
+		start1,start2 = 0,0
+		for t in ad_terms:
+			end1,end2 = start1+t.size_ad1,start2+t.size_ad2
+			coef1[...,start1:end1],index[...,start1:end1] = t.coef1,t.index
+			coef2[...,start2:end2],index_row[...,start2:end2],index_col[...,start2:end2] = (
+				t.coef2,t.index_row,t.index_col)
+			start1,start2 = end1,end2
+		return spAD2(value,coef1,index,coef2,index_row,index_col)
 
 	def simplify_ad(self):
-		spHelper1 = Sparse.spAD(self.value,self.coef1,self.index)
-		spHelper1.simplify_ad()
-		self.coef1,self.index = spHelper1.coef,spHelper1.index
+		self.coef1,self.index = _simplify_sparse(self.coef1,self.index)
 
-		n_col = 1+np.max(self.index_col)
-		spHelper2 = Sparse.spAD(self.value,self.coef2,self.index_row*n_col + self.index_col)
-		spHelper2.simplify_ad()
-		self.coef2,self.index_row,self.index_col = spHelper2.coef, spHelper2.index//n_col, spHelper2.index%n_col
+		# Encode (row,col) pairs as single indices, with a wider type if needed to avoid overflow
+		col_min = np.min(self.index_col,initial=0)
+		n_col = 1+np.max(self.index_col,initial=0)-col_min
+		row,dtype = self.index_row,self.index_row.dtype
+		if int(n_col)*(1+int(np.max(np.abs(row),initial=0))) >= np.iinfo(dtype).max: row = row.astype(np.int64)
+		coef2,index2 = _simplify_sparse(self.coef2,row*n_col + (self.index_col-col_min))
+		self.coef2 = coef2
+		self.index_row,self.index_col = (e.astype(dtype,copy=False) for e in (index2//n_col, index2%n_col+col_min))
 
 # -------- End of class spAD2 -------
 
@@ -411,6 +481,41 @@ def _flatten_nlast(a,n):
 	s=a.shape
 	return a.reshape(s[:-n]+(np.prod(s[-n:]),))
 
+def _simplify_sparse(coef,index):
+	"""
+	Sums the coefficients associated with identical indices, and removes the null coefficients,
+	along the last axis. Indices are sorted, and padded with null coefficients.
+	"""
+	bad_index = np.iinfo(index.dtype).max
+	key = np.where(coef!=0,index,bad_index)
+	order = np.argsort(key,axis=-1)
+	key,coef = (np.take_along_axis(e,order,axis=-1) for e in (key,coef))
+
+	# Rank of each distinct index, in increasing order, and dummy rank for removed entries
+	valid = key!=bad_index
+	new = valid.copy()
+	new[...,1:] &= key[...,1:]!=key[...,:-1]
+	rank = np.cumsum(new,axis=-1)-1
+	size_ad = 1+np.max(rank,initial=-1)
+	rank = np.where(valid,rank,size_ad)
+
+	coef_out = _scatter_add_last(coef,rank,size_ad+1).astype(coef.dtype,copy=False)
+	index_out = np.zeros(key.shape[:-1]+(size_ad+1,),dtype=index.dtype)
+	np.put_along_axis(index_out,rank,key,axis=-1)
+	return coef_out[...,:size_ad],index_out[...,:size_ad]
+
+def _scatter_add_last(coef,index,size):
+	"""
+	Dense array of shape coef.shape[:-1]+(size,), where the entries of coef 
+	are summed at the positions given by index along the last axis.
+	"""
+	shape = coef.shape[:-1]
+	n = int(np.prod(shape))
+	assert np.max(index,initial=-1)<size
+	flat_index = index.reshape((n,index.shape[-1])) + size*_add_dim(np.arange(n))
+	result = np.bincount(flat_index.reshape(-1),weights=coef.reshape(-1),minlength=n*size)
+	return result.reshape(shape+(size,))
+
 # -------- Factory method -----
 
 def identity(*args,**kwargs):
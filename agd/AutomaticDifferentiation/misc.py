@@ -18,8 +18,8 @@ def _add_dim2(a):		return _add_dim(_add_dim(a))
 def key_expand(key,depth=1): 
 	"""Modifies a key to access an array with more dimensions. Needed if ellipsis is used."""
 	if isinstance(key,tuple):
-		if any(a is ... for a in key):
-			return key + (slice(None),)*depth
+		for a in key: # Plain loop, faster than any(...) with a generator on these short tuples
+			if a is ...: return key + (slice(None),)*depth
 	return key
 
 def _pad_last(a,pad_total): # Always makes a deep copy
@@ -36,6 +36,22 @@ def _concatenate(a,b,shape=None):
 		if b.shape[:-1]!=shape: b = np.broadcast_to(b,shape+b.shape[-1:])
 	return np.concatenate((a,b),axis=-1)
 
+def _concatenate_padded(arrays,axis,pad_total):
+	"""
+	Concatenates arrays along the given axis, after padding their last axis with zeros.
+	Padding is done in place in the output, and skipped if the sizes already match.
+	"""
+	if all(a.shape[-1]==pad_total for a in arrays): return np.concatenate(arrays,axis=axis)
+	lens = [a.shape[axis] for a in arrays]
+	shape = list(arrays[0].shape); shape[axis]=sum(lens); shape[-1]=pad_total
+	result = np.zeros(shape,dtype=np.result_type(*arrays))
+	start = 0
+	for a,n in zip(arrays,lens):
+		key = [slice(None)]*len(shape); key[axis]=slice(start,start+n); key[-1]=slice(0,a.shape[-1])
+		result[tuple(key)] = a
+		start+=n
+	return result
+
 def _set_shape_free_bound(shape,shape_free,shape_bound):
 	if shape_free is not None:
 		assert shape_free==shape[0:len(shape_free)]
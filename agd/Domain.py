@@ -3,8 +3,8 @@ from . import AutomaticDifferentiation as ad
 from . import LinearParallel as lp
 
 import numpy as np
-from functools import reduce
-from itertools import cycle
+import itertools
+from functools import reduce,lru_cache
 
 class Domain(object):
 	"""
@@ -13,15 +13,11 @@ class Domain(object):
 	and some related methods.
 	"""
 
-	def __init__(self):
-		s2 = np.sqrt(2.)
-		self.pattern_ball = np.stack([[1.,0.],[s2,s2],[0.,1.],[-s2,s2],
-			[-1.,0.],[-s2,-s2],[0.,-1.],[s2,-s2]],axis=1)
-
 	def level(self,x):
 		"""
 		A level set function, negative inside the domain, positive outside.
 		Guaranteed to be 1-Lipschitz.
+		The output may be a read-only array (e.g. for WholeSpace) : copy it before modifying.
 		"""
 		raise ValueError("""Domain level set function must be specialized""")
 
@@ -36,6 +32,7 @@ class Domain(object):
 		A union of disjoint intervals, sorted in increasing order, such 
 		] a[0],b[0] [ U ] a[1],b[1] [ U ... U ] a[n-1],b[n-1] [
 		such that x+h*v lies in the domain iff t lies on one of these intervals.
+		The outputs may be read-only arrays (e.g. for WholeSpace) : copy them before modifying.
 		"""
 		raise ValueError("""Domain intervals function must be specialized""")
 
@@ -44,9 +41,8 @@ class Domain(object):
 		Output : Least h>=0 such that x+h*v intersects the boundary.
 		"""
 		a,b = self.intervals(x,v)
-		a[a<0]=np.inf
-		b[b<0]=np.inf
-		return np.minimum(a.min(axis=0),b.min(axis=0))
+		return np.minimum(np.where(a<0,np.inf,a).min(axis=0),
+			np.where(b<0,np.inf,b).min(axis=0))
 
 	def contains_ball(self,x,h):
 		if h==0.: 	return self.contains(x)
@@ -57,29 +53,55 @@ class Domain(object):
 		# Fix boundary layer
 		mask = np.logical_and(inside,level>-h) # Recall level is 1-Lipschitz
 		xm=x[:,mask]
-		ball_pattern = fd.as_field(self.pattern_ball,xm.shape[1:],conditional=False)
-		xb = np.expand_dims(xm,axis=1)+h*ball_pattern
-		inside[mask] = np.all(self.contains(xb),axis=0)
+		# Test one direction at a time, only for the points not yet excluded
+		contained = np.ones(xm.shape[1:],dtype=bool)
+		for e in _pattern_ball(len(x)):
+			active = np.flatnonzero(contained)
+			if active.size==0: break
+			contained[active] = self.contains(xm[:,active]+h*e[:,None])
+		inside[mask] = contained
 		return inside
 
+@lru_cache(maxsize=None)
+def _pattern_ball(d):
+	"""
+	Unit directions probed by contains_ball, with shape (n_dirs,d) : 
+	the axes +-e_i, and in dimension two and three the diagonals.
+	"""
+	eye = np.eye(d)
+	dirs = [eye,-eye]
+	if d in (2,3): dirs.append(np.array(list(itertools.product((1.,-1.),repeat=d)))/np.sqrt(d))
+	pattern = np.concatenate(dirs,axis=0)
+	pattern.flags.writeable = False # Shared by all callers
+	return pattern
+
+def _freeway_convex(a,b):
+	"""
+	Least h>=0 in {a,b}, or +infinity, where a<=b are the bounds of a single interval.
+	"""
+	return np.where(a>=0,a,np.where(b>=0,b,np.inf))
+
 class WholeSpace(Domain):
 	"""
 	This class represents the full space R^d.
 	"""
+	# Constant outputs are returned as read-only broadcast views, see Domain.level
 	def level(self,x):
-		return np.full(x.shape[1:],-np.inf)
+		return np.broadcast_to(-np.inf,x.shape[1:])
 
 	def intervals(self,x,v):
 		shape = (1,)+x.shape[1:]
-		return np.full(shape,-np.inf),np.full(shape,np.inf)
+		return np.broadcast_to(-np.inf,shape),np.broadcast_to(np.inf,shape)
 
 class Ball(Domain):
 	"""
 	This class represents a ball shaped domain
+	Optional dtype : e.g. np.float32, for computations in single precision.
 	"""
 
-	def __init__(self,center=(0.,0.),radius=1.):
+	def __init__(self,center=(0.,0.),radius=1.,dtype=None):
 		super(Ball,self).__init__()
+		if dtype is not None: center,radius = (np.asarray(e,dtype=dtype) for e in (center,radius))
 		self.center = ad.toarray(center)
 		self.radius = radius
 
@@ -91,13 +113,13 @@ class Ball(Domain):
 		_x = self._centered(x)
 		return ad.Optimization.norm(_x,ord=2,axis=0)-self.radius
 
-	def intervals(self,x,v):
+	def _interval(self,x,v):
+		"""
+		Single interval, since the domain is convex, with the shape of the grid.
+		"""
 		if v.shape!=x.shape: v=fd.as_field(v,x.shape[1:],conditional=False)
 		xc = self._centered(x)
 
-		begin = np.full(x.shape[1:],np.inf)
-		end = begin.copy()
-
 		# Solve |x+hv|^2=r, which is a quadratic equation a h^2 + 2 b h + c =0
 		a = lp.dot_VV(v,v)
 		b = lp.dot_VV(xc,v)
@@ -105,24 +127,30 @@ class Ball(Domain):
 
 		delta = b*b-a*c
 
+		# Branchless evaluation on the full grid, invalid entries discarded afterwards
 		pos = np.logical_and(a>0,delta>0)
-		a,b,delta = (e[pos] for e in (a,b,delta))
+		safe_a = np.where(a>0,a,1.)
+		sdelta = np.sqrt(np.maximum(delta,0.))
+		begin = np.where(pos,(-b-sdelta)/safe_a,np.inf)
+		end   = np.where(pos,(-b+sdelta)/safe_a,np.inf)
+		return begin,end
 
-		sdelta = np.sqrt(delta)
-		begin[pos] = (-b-sdelta)/a
-		end[pos] = (-b+sdelta)/a
+	def intervals(self,x,v):
+		return tuple(np.expand_dims(e,axis=0) for e in self._interval(x,v))
 
-		begin,end = (np.expand_dims(e,axis=0) for e in (begin,end))
-		return begin,end
+	def freeway(self,x,v):
+		return _freeway_convex(*self._interval(x,v))
 
 class Box(Domain):
 	"""
 	This class represents a box shaped domain.
+	Optional dtype : e.g. np.float32, for computations in single precision.
 	"""
 
-	def __init__(self,sides = ((0.,1.),(0.,1.)) ):
+	def __init__(self,sides = ((0.,1.),(0.,1.)), dtype=None):
 		super(Box,self).__init__()
-		if not isinstance(sides,np.ndarray): sides=np.array(sides)
+		if not isinstance(sides,np.ndarray) or dtype is not None: 
+			sides=np.array(sides,dtype=dtype)
 		self._sides = sides
 		self._center = sides.sum(axis=1)/2.
 		self._hlen = (sides[:,1]-sides[:,0])/2.
@@ -141,42 +169,55 @@ class Box(Domain):
 
 
 	def level(self,x):
-		hlen = fd.as_field(self._hlen,x.shape[1:],conditional=False)
-		return (self._centered(x) - hlen).max(axis=0)
+		if ad.is_ad(x) or x.ndim==1:
+			hlen = fd.as_field(self._hlen,x.shape[1:],conditional=False)
+			return (self._centered(x) - hlen).max(axis=0)
+
+		# Accumulate max_k |x_k-c_k|-h_k axis by axis, in grid sized buffers
+		result = None
+		for xk,ck,hk in zip(x,self.center,self._hlen):
+			xk = xk-ck
+			np.abs(xk,out=xk)
+			xk -= hk
+			if result is None: result = xk
+			else: np.maximum(result,xk,out=result)
+		return result
 
-	def intervals(self,x,v):
+	def _interval(self,x,v):
+		"""
+		Single interval, since the domain is convex, with the shape of the grid.
+		"""
 		shape = x.shape[1:]
 		if v.shape!=x.shape: v=fd.as_field(v,shape,conditional=False)
-		hlen = fd.as_field(self._hlen,shape,conditional=False)
-		xc,signs = self._centered(x,signs=True)
-		vc = v*signs
-
-		a=np.full(x.shape,-np.inf)
-		b=np.full(x.shape, np.inf)
-
-		# Compute the interval corresponding to each axis
-		pos = vc!=0
-		hlen_,xc_,vc_ = (e[pos] for e in (hlen,xc,vc))
 
-		a[pos] = (-hlen_-xc_)/vc_
-		b[pos] = ( hlen_-xc_)/vc_
-
-		# Deal with offsets parallel to axes
-		pos = np.logical_and(vc==0.,np.abs(xc)>hlen)
-		a[pos] = np.inf 
-
-		# Intersect intervals corresponding to different axes
-
-		a,b = np.minimum(a,b),np.maximum(a,b)
-		a,b = a.max(axis=0),b.min(axis=0)
-		a,b = (ad.toarray(e) for e in (a,b)) 
+		# Slab test, accumulating the intersection of the intervals axis by axis
+		dtype = np.result_type(x,v,self._hlen,1.)
+		inf,minf = (np.array(e,dtype=dtype) for e in (np.inf,-np.inf))
+		a = b = None
+		for xk,vk,ck,hk in zip(x,v,self.center,self._hlen):
+			xk = xk-ck
+			pos = vk!=0
+			# Offsets parallel to the axis yield ]-inf,inf[ from inside the slab, 
+			# and an empty interval from outside.
+			ak_par = np.where(np.abs(xk)>hk,inf,minf)
+			# Reflecting so that the offset is positive, the interval is 
+			# ]-(hk+xk)/vk, (hk-xk)/vk[ 
+			xk = xk*np.sign(vk) # Not in place, since AD coefficients may be read-only
+			vk = np.where(pos,np.abs(vk),1.)
+			ak = np.where(pos,-(hk+xk)/vk,ak_par)
+			bk = np.where(pos, (hk-xk)/vk,np.inf)
+			if a is None: a,b = ak,bk
+			else: np.maximum(a,ak,out=a); np.minimum(b,bk,out=b)
 
 		# Normalize empty intervals
 		pos = a>b
-		a[pos]=np.inf
-		b[pos]=np.inf
-		a,b = (np.expand_dims(e,axis=0) for e in (a,b))
-		return a,b
+		return np.where(pos,np.inf,a),np.where(pos,np.inf,b)
+
+	def intervals(self,x,v):
+		return tuple(np.expand_dims(e,axis=0) for e in self._interval(x,v))
+
+	def freeway(self,x,v):
+		return _freeway_convex(*self._interval(x,v))
 
 class AbsoluteComplement(Domain):
 	"""
@@ -194,8 +235,10 @@ class AbsoluteComplement(Domain):
 		return self.dom.freeway(x,v)
 	def intervals(self,x,v):
 		a,b = self.dom.intervals(x,v)
-		inf = np.full((1,)+x.shape[1:],np.inf)
-		return np.concatenate((-inf,b),axis=0),np.concatenate((a,inf),axis=0)
+		# Broadcast views, since concatenate copies anyway
+		shape = (1,)+x.shape[1:]
+		inf,minf = np.broadcast_to(np.inf,shape),np.broadcast_to(-np.inf,shape)
+		return np.concatenate((minf,b),axis=0),np.concatenate((a,inf),axis=0)
 
 
 class Intersection(Domain):
@@ -207,12 +250,15 @@ class Intersection(Domain):
 		self.doms=doms
 
 	def contains(self,x):
-		containss = [dom.contains(x) for dom in self.doms]
-		return reduce(np.logical_and,containss)
+		# Subdomains are tested in turn, stopping once no point remains inside
+		result = np.array(self.doms[0].contains(x),dtype=bool)
+		for dom in self.doms[1:]:
+			if not result.any(): break
+			result &= dom.contains(x)
+		return result
 
 	def level(self,x):
-		levels = [dom.level(x) for dom in self.doms]
-		return reduce(np.maximum,levels)
+		return _accumulate(np.maximum,[dom.level(x) for dom in self.doms])
 
 	def intervals(self,x,v):
 		intervalss = [dom.intervals(x,v) for dom in self.doms]
@@ -221,77 +267,93 @@ class Intersection(Domain):
 
 		# Shortcut for the convex case, quite common
 		if all(len(a)==1 for a,b in intervalss):
-			beg = reduce(np.maximum,begs)
-			end = reduce(np.minimum,ends)
+			beg = _accumulate(np.maximum,begs)
+			end = _accumulate(np.minimum,ends)
 			pos = beg>end
-			beg[pos]=np.inf
-			end[pos]=np.inf
-			return beg,end
+			return np.where(pos,np.inf,beg),np.where(pos,np.inf,end)
 
 		# General non-convex case
-		shape = x.shape[1:]
-
-		# Prepare the result
-		begr = []
-		endr = []
-		val = np.full(shape,-np.inf)
-		inds = np.full( (len(self.doms),)+x.shape[1:], 0)
-		
-		def tax(arr,ind,valid):
-			return np.squeeze(np.take_along_axis(arr[:,valid],np.expand_dims(ind[valid],axis=0),axis=0),axis=0)
-
-		counter=0
-		while True:
-			# Find the next beginning
-			unchanged=0
-			for it,(beg,end) in cycle(enumerate(zip(begs,ends))):
-				ind=ad.toarray(inds[it])
-				valid = ind<len(end)
-				pos = np.full(shape,False)
-				endiv = tax(end,ind,valid)
-				pos[valid] = np.logical_and(val[valid]>=endiv,endiv!=np.inf)
-
-				if pos.any():	
-					unchanged=0
-				else:			
-					unchanged+=1
-					if unchanged>=len(begs):
-						break
-
-				inds[it,pos]+=1; ind=inds[it] 
-				valid = ind<len(end)
-				val[valid] = np.maximum(val[valid],tax(beg,ind,valid))
-				val[np.logical_not(valid)]=np.inf
-
-				counter+=1
-				assert(counter<=100)
-
-			#Exit if nobody's valid
-			if (val==np.inf).all():
-				break
-			begr.append(val)
-
-			# Find the next end
-			val=np.full(shape,np.inf)
-			for end,ind in zip(ends,inds):
-				valid = ind<len(end)
-				val[valid] = np.minimum(val[valid],tax(end,ind,valid))
-
-			endr.append(val.copy())
-
-		return np.array(begr),np.array(endr)
+		return _sweep_intervals(begs,ends,len(self.doms))
 	
+def _accumulate(ufunc,arrays):
+	"""
+	Reduces a list of arrays using a binary ufunc, in place in a single new buffer.
+	"""
+	if ad.is_ad(arrays,iterables=(list,)): return reduce(ufunc,arrays)
+	if len(arrays)==1: return np.array(arrays[0])
+	out = ufunc(arrays[0],arrays[1])
+	for arr in arrays[2:]: ufunc(out,arr,out=out)
+	return out
+
+def _sweep_intervals(begs,ends,m):
+	"""
+	Points covered by at least m among several unions of disjoint open intervals, 
+	computed for all points at once by sorting the interval endpoints.
+	(m = number of domains for an intersection, m=1 for a union.)
+	Inputs : 
+	- begs, ends : lists of arrays of shape (k_i,)+shape, one per domain.
+	Output : arrays of shape (k,)+shape, padded with empty intervals ]inf,inf[.
+	"""
+	n = len(begs)
+	beg,end = np.concatenate(begs,axis=0),np.concatenate(ends,axis=0)
+	shape = beg.shape[1:]
+	valid = beg<end
+
+	# Sweep over the endpoints, counting the domains containing the current position.
+	# Ends come first, so that they are processed first in case of ties.
+	events = np.concatenate((np.where(valid,end,np.inf),np.where(valid,beg,np.inf)),axis=0)
+	# Small integer types reduce the memory traffic of the gathers and cumulative sums
+	itype = np.int8 if n<np.iinfo(np.int8).max else int
+	weights = valid.astype(itype)
+	weights = np.concatenate((-weights,weights),axis=0)
+	order = np.argsort(events,axis=0,kind='stable')
+	events = np.take_along_axis(events,order,axis=0)
+	weights = np.take_along_axis(weights,order,axis=0)
+	count = np.cumsum(weights,axis=0,dtype=itype)
+
+	opening = np.logical_and(weights==1,count==m)
+	closing = np.logical_and(weights==-1,count==m-1)
+	k = max(1,np.max(opening.sum(axis=0),initial=0))
+
+	# Each closing event matches the latest opening event, hence shares its rank
+	rank = np.cumsum(opening,axis=0)-1
+	def compact(mask):
+		result = np.full((k+1,)+shape,np.inf)
+		np.put_along_axis(result,np.where(mask,rank,k),events,axis=0)
+		return result[:k]
+
+	return compact(opening),compact(closing)
+
 def Complement(dom1,dom2):
 	"""
 	Relative complement dom1 \\ dom2
 	"""
 	return Intersection(dom1,AbsoluteComplement(dom2))
 
-def Union(*doms):
+class Union(Domain):
 	"""
-	Union of several domains.
+	This class represents a union of several subdomains.
 	"""
-	return AbsoluteComplement(Intersection(*[AbsoluteComplement(dom) for dom in doms]))
+	def __init__(self,*doms):
+		super(Union,self).__init__()
+		self.doms=doms
+
+	def contains(self,x):
+		# Subdomains are tested in turn, stopping once all points are inside
+		result = np.array(self.doms[0].contains(x),dtype=bool)
+		for dom in self.doms[1:]:
+			if result.all(): break
+			result |= dom.contains(x)
+		return result
+
+	def level(self,x):
+		return _accumulate(np.minimum,[dom.level(x) for dom in self.doms])
+
+	def intervals(self,x,v):
+		intervalss = [dom.intervals(x,v) for dom in self.doms]
+		begs = [a for a,b in intervalss]
+		ends = [b for a,b in intervalss]
+		return _sweep_intervals(begs,ends,1)
 
 class Band(Domain):
 	"""
@@ -308,8 +370,7 @@ class Band(Domain):
 			self.bounds/=norm
 
 	def _dotdir(self,x):
-		direction = fd.as_field(self.direction,x.shape[1:],conditional=False)
-		return lp.dot_VV(x,direction)
+		return lp.dot_VV(x,fd.as_field(self.direction,x.shape[1:],conditional=False))
 
 	def level(self,x):
 		xd = self._dotdir(x)
@@ -319,19 +380,16 @@ class Band(Domain):
 		xd = self._dotdir(x)
 		vd = self._dotdir(v)
 		vd = fd.as_field(vd,xd.shape)
-		a = np.full(xd.shape,-np.inf)
-		b = np.full(xd.shape, np.inf)
 
-		# Non degenerate case
+		# Non degenerate case, evaluated on the full grid
 		mask = vd!=0
-		xdm,vdm = xd[mask],vd[mask]
-		a[mask] = (self.bounds[0]-xdm)/vdm
-		b[mask] = (self.bounds[1]-xdm)/vdm
-		# Handle the case where vd=0
+		vd_ = np.where(mask,vd,1.)
+		t0 = (self.bounds[0]-xd)/vd_
+		t1 = (self.bounds[1]-xd)/vd_
+		# Case where vd=0 : whole line, or empty interval
 		inside = np.logical_and(self.bounds[0]<xd,xd<self.bounds[1])
-		a[np.logical_and(vd==0,np.logical_not(inside))]=np.inf
-
-		a,b = np.minimum(a,b),np.maximum(a,b)
+		a = np.where(mask,np.minimum(t0,t1),np.where(inside,-np.inf,np.inf))
+		b = np.where(mask,np.maximum(t0,t1),np.inf)
 		a,b = (np.expand_dims(e,axis=0) for e in (a,b))
 		return a,b
 
@@ -374,43 +432,44 @@ class AffineTransform(Domain):
 		self._mult_inv = (None if mult is None else 
 			(ad.toarray(1./mult) if mult.ndim==0 else np.linalg.inv(mult) ) )
 		self._mult_inv_norm = (1. if self._mult_inv is None 
+			else np.abs(self._mult_inv) if mult.ndim==0 
 			else np.linalg.norm(self._mult_inv,ord=2) )
 
 	def forward(self,x,linear=False):
 		"""
 		Forward affine transformation, from the original domain to the transformed one.
 		"""
-		x=x.copy()
-		shape = x.shape[1:]
-
 		mult = self._mult
-		if mult is None: 	pass
-		elif mult.ndim==0:	x*=mult
-		else: x=lp.dot_AV(fd.as_field(mult,shape,conditional=False),x)
-
-		if not linear and self._shift is not None:
-			x+=fd.as_field(shift,shape,conditional=False)
-		
+		shift = None if linear else self._shift
+		if mult is not None: x = self._linear(mult,x)
+		if shift is not None:
+			shift = fd.as_field(shift,x.shape[1:],conditional=False)
+			if mult is None: x = x+shift
+			else: x+=shift
 		return x
 
 	def reverse(self,x,linear=False):
 		"""
 		Reverse affine transformation, from the transformed domain to the original one.
 		"""
-		x=x.copy()
-		shape = x.shape[1:]
-
-		shift = self._shift
-		if (shift is None) or linear: 	pass
-		else:	x-=fd.as_field(shift,shape,conditional=False)
+		shift = None if linear else self._shift
+		if shift is not None: x = x-fd.as_field(shift,x.shape[1:],conditional=False)
 
 		mult = self._mult_inv
-		if mult is None: 	pass
-		elif mult.ndim==0:	x*=mult
-		else: x = lp.dot_AV(fd.as_field(mult,shape,conditional=False),x)
-
+		if mult is None: pass
+		# In place if x-shift is a new buffer, except for AD variables whose coefficients are aliased
+		elif mult.ndim==0 and shift is not None and not ad.is_ad(x): x*=mult
+		else: x = self._linear(mult,x)
 		return x
 
+	def _linear(self,mult,x):
+		"""
+		Applies the linear part of the transformation, without modifying x.
+		"""
+		if mult.ndim==0: return mult*x
+		if ad.is_ad(x) or ad.is_ad(mult): return lp.dot_AV(fd.as_field(mult,x.shape[1:],conditional=False),x)
+		return np.tensordot(mult,x,axes=1)
+
 	def contains(self,x):
 		return self.dom.contains(self.reverse(x))
 	def level(self,x):
@@ -501,28 +560,29 @@ class Dirichlet(object):
 
 	@property
 	def _ExteriorNaNs(self):
-		result = np.zeros(self.grid.shape[1:])
-		result[self.not_interior]=np.nan
-		return result
+		return np.where(self.interior,0.,np.nan)
 
 	def _BoundaryLayer(self,u,du):
 		"""
 		Returns positions at which u is defined but du is not.
 		"""
-		return np.logical_and.reduce([
-			np.isnan(du),
-			np.broadcast_to(self.interior,du.shape),
-			np.broadcast_to(np.logical_not(np.isnan(u)),du.shape)
-			])
+		# Conditions on u are combined on the grid, then broadcast in place against du.
+		# A fresh mask is returned, since DiffCentered holds one across a DiffUpwind call.
+		valid = np.isnan(u)
+		np.logical_not(valid,out=valid)
+		valid &= self.interior
+		mask = np.isnan(du)
+		mask &= valid
+		return mask
 
 	def _DiffUpwindDirichlet(self,u,offsets,grid,reth):
 		"""
 		Returns first order finite differences w.r.t. boundary value.
 		"""
 		h = self.domain.freeway(grid,offsets)
-		x = grid+h*offsets
-		xvalues = self.value(x)
-		result = (xvalues-u)/h
+		x = h*offsets; x+=grid
+		result = self.value(x)-u
+		result/=h
 		return (result,h) if reth else result
 
 
@@ -533,19 +593,22 @@ class Dirichlet(object):
 		"""
 		assert(isinstance(reth,bool))
 		grid=self.grid
+		offsets = np.asarray(offsets)
 		du = fd.DiffUpwind(u+self._ExteriorNaNs,offsets,self.gridscale)
 		mask = self._BoundaryLayer(u,du)
-		offsets = fd.as_field(np.array(offsets),u.shape)
-		um = ad.broadcast_to(u,offsets.shape[1:])[mask]
-		om = offsets[:,mask]
-		gm = ad.broadcast_to(grid.reshape( (len(grid),)+(1,)*(offsets.ndim-grid.ndim)+u.shape),offsets.shape)[:,mask]
-#		um,om,gm = u[mask], offsets[:,mask], grid[:,mask]
+
+		# Gather the boundary layer only, the trailing indices refer to grid positions
+		idx = np.nonzero(mask)
+		idx_grid = idx[len(idx)-u.ndim:]
+		um = u[idx_grid]
+		om = fd.as_field(offsets,u.shape)[(slice(None),)+idx]
+		gm = grid[(slice(None),)+idx_grid]
 		if not reth: 
-			du[mask] = self._DiffUpwindDirichlet(um,om,gm,reth=reth)
+			du[idx] = self._DiffUpwindDirichlet(um,om,gm,reth=reth)
 			return du
 		else: 
-			hr = np.full(offsets.shape[1:],self.gridscale)
-			du[mask],hr[mask] = self._DiffUpwindDirichlet(um,om,gm,reth=reth)
+			hr = np.full(du.shape,self.gridscale)
+			du[idx],hr[idx] = self._DiffUpwindDirichlet(um,om,gm,reth=reth)
 			return du,hr
 
 	def DiffCentered(self,u,offsets):
@@ -569,8 +632,9 @@ class Dirichlet(object):
 		Second order accurate in the interior, 
 		but only first order accurate at the boundary.
 		"""
-		du0,h0 = self.DiffUpwind(u, offsets,		  reth=True)
-		du1,h1 = self.DiffUpwind(u,-np.array(offsets),reth=True)
+		offsets = np.asarray(offsets)
+		du0,h0 = self.DiffUpwind(u, offsets,reth=True)
+		du1,h1 = self.DiffUpwind(u,-offsets,reth=True)
 
 		return (du0+du1)*(2./(h0+h1))
 
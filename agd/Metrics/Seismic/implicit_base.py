@@ -37,9 +37,10 @@ class ImplicitBase(Base):
 
 	def is_topographic(self,a=None):
 		if a is None: a = self.inverse_transformation
-		if a in None: return True
+		if a is None: return True
 		d = self.vdim
-		return np.all([a[i,j]==(i==j) for i in range(d) for j in range(d-1)])
+		eye = np.eye(d)[:,:d-1]
+		return bool(np.all(a[:,:d-1]==eye.reshape(eye.shape+(1,)*(a.ndim-2))))
 
 	def flatten_transform(self,topographic=None):
 		a = self.inverse_transformation
@@ -48,7 +49,7 @@ class ImplicitBase(Base):
 		if topographic is None: topographic = self.is_topographic(a)
 		d=self.vdim
 		if topographic:
-			return ad.array([a[i,-1] in range(d-1)] + [a[d-1,d-1]-1])
+			return ad.array([a[i,-1] for i in range(d-1)] + [a[d-1,d-1]-1])
 		else:
 			return a.reshape((d*d,)+a.shape[2:])
 
@@ -102,19 +103,22 @@ def sequential_quadratic(v,f,niter,x=None,params=tuple(),relax=tuple()):
 	params : to be passed to evaluated function. Special treatment if ad types.
 	"""
 	if x is None: x=np.zeros(v.shape)
-	x_ad = ad.Dense2.identity(constant=x,shape_free=(len(x),))
+	# Allocated once, and updated in place. (The AD coefficients of x_ad are constant.)
+	x_ad = ad.Dense2.identity(constant=np.array(x,dtype=float),shape_free=(len(x),))
 
 	# Fixed point iterations 
 	def step(val,V,D,v):
 		M = lp.inverse(D)
-		k = np.sqrt((lp.dot_VAV(V,M,V)-2.*val)/lp.dot_VAV(v,M,v))
-		return lp.dot_AV(M,k*v-V)
+		# Products with M are computed once, and reused in M(kv-V) = k Mv - MV
+		MV,Mv = lp.dot_AV(M,V),lp.dot_AV(M,v)
+		k = np.sqrt((lp.dot_VV(V,MV)-2.*val)/lp.dot_VV(v,Mv))
+		return k*Mv-MV
 
 	# Initial iterations ignoring AD information in params
 	params_noad = tuple(ad.remove_ad(val) for val in params) 
 	for r in relax + (0.,)*niter:
 		f_ad = f(x_ad,params_noad,relax=r)
-		x_ad = x_ad+step(f_ad.value,f_ad.gradient(),f_ad.hessian(),v)
+		x_ad.value[...] += step(f_ad.value,f_ad.gradient(),f_ad.hessian(),v)
 
 	x=x_ad.value
 